@@ -1,36 +1,165 @@
 """
 FastAPI application for LLM Evaluation - UPDATED
 """
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
-from models import MultiResponseRequest, MultiResponseResponse, FeedbackRequest, EvaluationResponse
-from database import mongodb
-from config import settings
+from models import MultiResponseRequest, MultiResponseResponse, FeedbackRequest, EvaluationResponse, StatsResponse
+from database import mongodb, EVALUATION_SCHEMA_VERSION
+from cache import redis_cache
+from config import get_settings
+import asyncio
+import atexit
 import logging
+import logging.config
+import logging.handlers
+import queue
 from datetime import datetime
 import uuid
+import orjson
+from bson import ObjectId
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+
+settings = get_settings()
+
+# Handlers only enqueue records; a listener thread does the blocking stderr writes
+LOG_QUEUE = queue.Queue(-1)
+
+LOGGING_CONFIG = {
+    "version": 1,
+    # Keep loggers created by modules imported before this runs (database, cache)
+    "disable_existing_loggers": False,
+    "handlers": {
+        "queue": {
+            "()": lambda: logging.handlers.QueueHandler(LOG_QUEUE)
+        }
+    },
+    "loggers": {
+        # Replace uvicorn's own stderr handlers so server and access logs go through the queue too
+        "uvicorn": {"handlers": ["queue"], "propagate": False},
+        "uvicorn.error": {"level": "INFO"},
+        "uvicorn.access": {"handlers": ["queue"], "propagate": False}
+    },
+    "root": {
+        "level": settings.log_level,
+        "handlers": ["queue"]
+    }
+}
+
+logging.config.dictConfig(LOGGING_CONFIG)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(LOG_QUEUE, _log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize Gemini
 genai.configure(api_key=settings.gemini_api_key)
 
-# In-memory storage for chat sessions (production mein Redis ya database use karna)
-chat_sessions = {}
+# Shared Gemini model, built once instead of per request
+GEMINI_MODEL = genai.GenerativeModel('gemini-2.0-flash')
+
+# Generate multiple responses with different temperatures
+GENERATION_CONFIGS = [
+    {"temperature": 0.3},  # More deterministic
+    {"temperature": 0.7},  # Balanced
+    {"temperature": 0.9}   # More creative
+]
+
+# Caps in-flight Gemini calls across all requests in this process to stay under
+# provider rate limits; each uvicorn worker holds its own semaphore
+GEMINI_SEM = asyncio.Semaphore(settings.gemini_max_concurrency)
+
+
+async def _start_generation(model, prompt: str, temperature: float, stream: bool = False):
+    """
+    Start a Gemini call under the concurrency cap, backing off exponentially on rate limits.
+    Returns with a GEMINI_SEM slot held; the caller must release it once the call is done.
+    """
+    for attempt in range(settings.gemini_max_retries + 1):
+        await GEMINI_SEM.acquire()
+        try:
+            return await model.generate_content_async(
+                prompt,
+                generation_config=genai.types.GenerationConfig(
+                    temperature=temperature,
+                    max_output_tokens=500
+                ),
+                stream=stream
+            )
+        except ResourceExhausted:
+            GEMINI_SEM.release()
+            if attempt == settings.gemini_max_retries:
+                raise
+        except BaseException:
+            GEMINI_SEM.release()
+            raise
+        # Sleep outside the semaphore so other calls can use the slot meanwhile
+        await asyncio.sleep(settings.gemini_retry_base_delay * (2 ** attempt))
+
+
+async def generate_with_limit(model, prompt: str, temperature: float):
+    """Call Gemini under the concurrency cap, retrying on rate limits"""
+    response = await _start_generation(model, prompt, temperature)
+    GEMINI_SEM.release()
+    return response
+
+
+async def stream_with_limit(model, prompt: str, temperature: float):
+    """Stream Gemini text chunks, holding a concurrency slot for the whole stream"""
+    response = await _start_generation(model, prompt, temperature, stream=True)
+    try:
+        async for chunk in response:
+            yield chunk.text
+    finally:
+        GEMINI_SEM.release()
+
+
+def new_chat_document(chat_id: str, user_prompt: str, responses: list, model_used: str):
+    """Build the evaluation document stored at generation time, before any feedback"""
+    now = datetime.utcnow()
+    return {
+        # Generated here so the ID can be returned without reading the insert result
+        "_id": ObjectId(),
+        "schema_version": EVALUATION_SCHEMA_VERSION,
+        
+        # Original prompt and responses
+        "user_prompt": user_prompt,
+        "all_responses": responses,
+        
+        # Metadata
+        "chat_id": chat_id,
+        "model_used": model_used,
+        
+        # Timestamps
+        "prompt_created_at": now,
+        "responses_created_at": now,
+        
+        # Calculated fields
+        "total_responses_shown": len(responses)
+    }
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan event handler for startup and shutdown"""
     # Startup
     logger.info("Starting up LLM Evaluation API...")
-    mongodb.connect()
+    await mongodb.connect()
+    await mongodb.warm_up()
+    mongodb.start_flusher()
+    # Redis connect() already awaits a ping, so its pool is warm before serving
+    await redis_cache.connect()
     yield
     # Shutdown
     logger.info("Shutting down LLM Evaluation API...")
-    mongodb.close()
+    await mongodb.stop_flusher()
+    await mongodb.close()
+    await redis_cache.close()
 
 
 # Initialize FastAPI app
@@ -61,6 +190,7 @@ async def root():
             "generate_responses": "/api/v1/generate-responses",
             "submit_feedback": "/api/v1/feedback",
             "health": "/health",
+            "stream_responses": "/api/v1/stream-responses",
             "stats": "/api/v1/stats",
             "docs": "/docs"
         }
@@ -72,14 +202,16 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test MongoDB connection
-        mongodb.client.admin.command('ping')
+        await mongodb.client.admin.command('ping')
         return {
             "status": "healthy",
             "database": "connected",
+            "pending_writes": mongodb.buffer.qsize(),
+            "failed_writes": mongodb.failed_writes,
             "timestamp": datetime.utcnow()
         }
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
+        logger.error("Health check failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Database connection failed"
@@ -91,96 +223,192 @@ async def health_check():
     response_model=MultiResponseResponse,
     tags=["Generation"]
 )
-async def generate_responses(request: MultiResponseRequest):
+async def generate_responses(request: MultiResponseRequest, cache: bool = True):
     """
     Generate multiple responses using Google Gemini
     Returns responses that user can choose from
+    
+    Repeat prompts are served from the response cache; cache=false bypasses it
+    for both lookup and storage.
     """
     try:
-        # Initialize Gemini model
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        responses = []
-        
-        # Generate multiple responses with different temperatures
-        generation_configs = [
-            {"temperature": 0.3},  # More deterministic
-            {"temperature": 0.7},  # Balanced
-            {"temperature": 0.9}   # More creative
-        ]
+        responses = None
+        if cache:
+            responses = await redis_cache.get_responses(
+                request.user_prompt, request.model_used, request.num_responses
+            )
         
-        for i, config in enumerate(generation_configs[:request.num_responses]):
-            try:
-                response = model.generate_content(
-                    request.user_prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=config["temperature"],
-                        max_output_tokens=500
-                    )
+        if responses is None:
+            # Fire all Gemini calls concurrently so latency is the slowest call, not the sum
+            tasks = [
+                generate_with_limit(GEMINI_MODEL, request.user_prompt, config["temperature"])
+                for config in GENERATION_CONFIGS[:request.num_responses]
+            ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            
+            responses = []
+            all_generated = True
+            for i, (config, result) in enumerate(zip(GENERATION_CONFIGS, results)):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    responses.append(result.text)
+                    logger.info("Generated response %d with temperature %s", i + 1, config["temperature"])
+                    
+                except Exception as e:
+                    logger.error("Error generating response %d: %s", i + 1, e)
+                    # Fallback response
+                    responses.append(f"Response {i+1}: This is a sample response for '{request.user_prompt}'")
+                    all_generated = False
+            
+            # Never cache fallback responses
+            if cache and all_generated:
+                await redis_cache.set_responses(
+                    request.user_prompt, request.model_used, request.num_responses, responses
                 )
-                responses.append(response.text)
-                logger.info(f"Generated response {i+1} with temperature {config['temperature']}")
-                
-            except Exception as e:
-                logger.error(f"Error generating response {i+1}: {e}")
-                # Fallback response
-                responses.append(f"Response {i+1}: This is a sample response for '{request.user_prompt}'")
         
         # Generate unique chat ID
         chat_id = str(uuid.uuid4())
         
-        # Store the session data for feedback
-        chat_sessions[chat_id] = {
-            "user_prompt": request.user_prompt,
-            "responses": responses,
-            "model_used": request.model_used,
-            "created_at": datetime.utcnow().isoformat()
-        }
+        # Persist the chat so feedback can be attached to it later
+        chat_document = new_chat_document(chat_id, request.user_prompt, responses, request.model_used)
+        await mongodb.insert_evaluation(chat_document)
         
-        logger.info(f"Generated {len(responses)} responses for user prompt: {request.user_prompt[:50]}...")
+        # Guard the prompt slice so it is only built when INFO is enabled
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Generated %d responses for user prompt: %r...", len(responses), request.user_prompt[:50])
         
         return MultiResponseResponse(
             success=True,
             message=f"Successfully generated {len(responses)} responses using Gemini",
             user_prompt=request.user_prompt,
             responses=responses,
-            chat_id=chat_id
+            chat_id=chat_id,
+            evaluation_id=str(chat_document["_id"])
         )
         
     except Exception as e:
-        logger.error(f"Error in generate_responses: {e}")
+        logger.error("Error in generate_responses: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to generate responses: {str(e)}"
         )
 
 
+@app.get("/api/v1/stream-responses", tags=["Generation"])
+async def stream_responses(
+    user_prompt: str,
+    model_used: str = "gemini-2.0-flash",
+    num_responses: int = 2
+):
+    """
+    Stream multiple responses using Google Gemini as Server-Sent Events
+    
+    Chunks from all responses are interleaved, each tagged with its response_index.
+    The final event carries the chat_id to use when submitting feedback and the
+    evaluation_id of the saved chat, or an "error" field instead if it could not be saved.
+    """
+    chat_id = str(uuid.uuid4())
+    configs = GENERATION_CONFIGS[:num_responses]
+    events = asyncio.Queue()
+    
+    async def produce(i: int, temperature: float):
+        parts = []
+        try:
+            async for text in stream_with_limit(GEMINI_MODEL, user_prompt, temperature):
+                parts.append(text)
+                await events.put({"response_index": i, "text": text})
+        except Exception as e:
+            logger.error("Error streaming response %d: %s", i + 1, e)
+            # Fallback response, only if nothing was streamed yet
+            if not parts:
+                parts.append(f"Response {i+1}: This is a sample response for '{user_prompt}'")
+                await events.put({"response_index": i, "text": parts[0]})
+        finally:
+            # None marks this stream as finished
+            await events.put(None)
+        return "".join(parts)
+    
+    async def event_stream():
+        tasks = [
+            asyncio.create_task(produce(i, config["temperature"]))
+            for i, config in enumerate(configs)
+        ]
+        try:
+            finished = 0
+            while finished < len(tasks):
+                event = await events.get()
+                if event is None:
+                    finished += 1
+                    continue
+                yield b"data: " + orjson.dumps(event) + b"\n\n"
+            
+            responses = [task.result() for task in tasks]
+            
+            # Persist the chat so feedback can be attached to it later
+            chat_document = new_chat_document(chat_id, user_prompt, responses, model_used)
+            try:
+                await mongodb.insert_evaluation(chat_document)
+            except Exception as e:
+                logger.error("Error saving streamed chat %s: %s", chat_id, e)
+                # Close the stream explicitly; without a saved chat there is no chat_id to rate
+                yield b"data: " + orjson.dumps({
+                    "done": True,
+                    "error": "Failed to save responses; feedback cannot be submitted for this chat",
+                    "responses": responses
+                }) + b"\n\n"
+                return
+            
+            yield b"data: " + orjson.dumps({
+                "done": True,
+                "chat_id": chat_id,
+                "evaluation_id": str(chat_document["_id"]),
+                "responses": responses
+            }) + b"\n\n"
+        finally:
+            # Stop generating if the client disconnects mid-stream
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
 @app.post(
     "/api/v1/feedback",
     response_model=EvaluationResponse,
     status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_202_ACCEPTED: {
+            "model": EvaluationResponse,
+            "description": "Feedback buffered for a batched write"
+        }
+    },
     tags=["Evaluation"]
 )
-async def submit_feedback(feedback: FeedbackRequest):
+async def submit_feedback(
+    feedback: FeedbackRequest,
+    response: Response,
+    wait_for_write: bool = False
+):
     """
     Submit feedback when user selects a preferred response
     
-    This is called when user clicks "I prefer this response" on any response
+    This is called when user clicks "I prefer this response" on any response.
+    Feedback is set on the chat document written by generate-responses; resubmitting
+    overwrites the previous feedback. The update is buffered and batched (202 Accepted)
+    unless wait_for_write=true or the buffer is full, in which case it is applied before
+    responding (201 Created, or 404 if the chat does not exist).
+    
+    A buffered update is not checked against the database before responding, so the
+    202 response has a null evaluation_id (generate-responses already returned it) and
+    an unknown chat_id is only logged and counted in /health. Clients that need the
+    404 must send wait_for_write=true.
     """
     try:
-        # Get the original chat session data
-        chat_data = chat_sessions.get(feedback.chat_id)
-        if not chat_data:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Chat session not found or expired"
-            )
+        now = datetime.utcnow()
         
-        # Prepare evaluation data for MongoDB
-        evaluation_data = {
-            # Original prompt and responses
-            "user_prompt": chat_data["user_prompt"],
-            "all_responses": chat_data["responses"],
+        # Feedback fields merged into the existing chat document
+        feedback_data = {
             "selected_response_index": feedback.selected_response_index,
             "selected_response_text": feedback.selected_response_text,
             
@@ -191,58 +419,78 @@ async def submit_feedback(feedback: FeedbackRequest):
             # Metadata
             "user_id": feedback.user_id,
             "session_id": feedback.session_id,
-            "chat_id": feedback.chat_id,
-            "model_used": chat_data["model_used"],
             
             # Timestamps
-            "prompt_created_at": chat_data["created_at"],
-            "responses_created_at": chat_data["created_at"],
-            "feedback_created_at": datetime.utcnow().isoformat(),
-            "server_received_at": datetime.utcnow().isoformat(),
-            
-            # Calculated fields
-            "total_responses_shown": len(chat_data["responses"])
+            "feedback_created_at": now,
+            "server_received_at": now
         }
         
-        # Insert into MongoDB
-        evaluation_id = mongodb.insert_evaluation(evaluation_data)
-        
-        # Clean up session data (optional)
-        # del chat_sessions[feedback.chat_id]
+        evaluation_id = None
+        queued = not wait_for_write and mongodb.queue_feedback(feedback.chat_id, feedback_data)
+        if queued:
+            response.status_code = status.HTTP_202_ACCEPTED
+        else:
+            # Single indexed round trip on the unique chat_id
+            evaluation_id = await mongodb.update_evaluation_feedback(feedback.chat_id, feedback_data)
+            if not evaluation_id:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Chat session not found"
+                )
         
-        logger.info(f"User {feedback.user_id} selected response {feedback.selected_response_index} with {feedback.thumbs} rating")
+        logger.info(
+            "User %s selected response %d with %s rating",
+            feedback.user_id, feedback.selected_response_index, feedback.thumbs
+        )
         
         return EvaluationResponse(
             success=True,
-            message="Feedback submitted successfully",
+            message="Feedback accepted" if queued else "Feedback submitted successfully",
             evaluation_id=evaluation_id
         )
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error saving feedback: {e}")
+        logger.error("Error saving feedback: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to save feedback: {str(e)}"
         )
 
 
-@app.get("/api/v1/stats", tags=["Statistics"])
+@app.get("/api/v1/stats", response_model=StatsResponse, tags=["Statistics"])
 async def get_stats():
     """
     Get basic statistics about stored evaluations
     """
     try:
-        total_evaluations = mongodb.collection.count_documents({})
-        thumbs_up = mongodb.collection.count_documents({"thumbs": "up"})
-        thumbs_down = mongodb.collection.count_documents({"thumbs": "down"})
+        # Serve from cache when fresh; dashboards poll this endpoint frequently
+        cached = await redis_cache.get_stats()
+        if cached:
+            return cached
         
-        # Additional stats
-        unique_users = len(mongodb.collection.distinct("user_id"))
-        unique_sessions = len(mongodb.collection.distinct("session_id"))
+        # Single round trip: one $facet pipeline computes every counter.
+        # Chats without feedback yet are excluded from all counters.
+        pipeline = [{"$match": {"thumbs": {"$exists": True}}}, {"$facet": {
+            "total": [{"$count": "n"}],
+            "up": [{"$match": {"thumbs": "up"}}, {"$count": "n"}],
+            "down": [{"$match": {"thumbs": "down"}}, {"$count": "n"}],
+            "users": [{"$group": {"_id": "$user_id"}}, {"$count": "n"}],
+            "sessions": [{"$group": {"_id": "$session_id"}}, {"$count": "n"}]
+        }}]
+        cursor = await mongodb.collection.aggregate(pipeline)
+        result = (await cursor.to_list(1))[0]
+        # $count emits no document for empty inputs, so default to 0
+        counts = {key: value[0]["n"] if value else 0 for key, value in result.items()}
         
-        return {
+        total_evaluations = counts["total"]
+        thumbs_up = counts["up"]
+        thumbs_down = counts["down"]
+        unique_users = counts["users"]
+        unique_sessions = counts["sessions"]
+        
+        stats = {
             "total_evaluations": total_evaluations,
             "thumbs_up": thumbs_up,
             "thumbs_down": thumbs_down,
@@ -250,8 +498,10 @@ async def get_stats():
             "unique_users": unique_users,
             "unique_sessions": unique_sessions
         }
+        await redis_cache.set_stats(stats)
+        return stats
     except Exception as e:
-        logger.error(f"Error fetching stats: {e}")
+        logger.error("Error fetching stats: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to fetch statistics: {str(e)}"
@@ -264,5 +514,8 @@ if __name__ == "__main__":
         "app:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        # "auto" picks uvloop when installed; uvloop has no Windows build
+        loop="auto",
+        http="httptools",
+        workers=settings.web_concurrency
     )
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Redis connection and response caching
+"""
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from config import get_settings
+import hashlib
+import logging
+import orjson
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Bump the version suffix whenever the stats payload shape changes
+STATS_KEY = "stats:v1"
+
+
+class RedisCache:
+    def __init__(self):
+        self.client = None
+    
+    async def connect(self):
+        """Connect to Redis; the cache is optional, so an unreachable server doesn't block startup"""
+        self.client = redis.Redis.from_url(
+            settings.redis_url,
+            socket_connect_timeout=settings.redis_socket_connect_timeout,
+            socket_timeout=settings.redis_socket_timeout
+        )
+        try:
+            # Test the connection
+            await self.client.ping()
+            logger.info("Successfully connected to Redis: %s", settings.redis_url)
+        except RedisError as e:
+            # Commands reconnect on demand; until then cache lookups are treated as misses
+            logger.warning("Redis unavailable, running without cache: %s", e)
+    
+    async def close(self):
+        """Close Redis connection"""
+        if self.client:
+            await self.client.aclose()
+            logger.info("Redis connection closed")
+    
+    async def get_stats(self):
+        """Fetch cached statistics, or None if missing/expired/unavailable"""
+        try:
+            raw = await self.client.get(STATS_KEY)
+        except RedisError as e:
+            logger.warning("Stats cache read failed, treating as miss: %s", e)
+            return None
+        return orjson.loads(raw) if raw else None
+    
+    async def set_stats(self, stats: dict):
+        """Cache computed statistics for a short TTL; failures are logged and ignored"""
+        try:
+            await self.client.set(STATS_KEY, orjson.dumps(stats), ex=settings.stats_cache_ttl)
+        except RedisError as e:
+            logger.warning("Stats cache write failed: %s", e)
+    
+    async def get_responses(self, user_prompt: str, model_used: str, num_responses: int):
+        """Fetch cached generated responses for an identical request, or None on miss/unavailable"""
+        try:
+            raw = await self.client.get(_responses_key(user_prompt, model_used, num_responses))
+        except RedisError as e:
+            logger.warning("Response cache read failed, treating as miss: %s", e)
+            return None
+        return orjson.loads(raw) if raw else None
+    
+    async def set_responses(self, user_prompt: str, model_used: str, num_responses: int, responses: list):
+        """Cache generated responses so repeat prompts skip Gemini; failures are logged and ignored"""
+        try:
+            await self.client.set(
+                _responses_key(user_prompt, model_used, num_responses),
+                orjson.dumps(responses),
+                ex=settings.response_cache_ttl
+            )
+        except RedisError as e:
+            logger.warning("Response cache write failed: %s", e)
+
+
+def _responses_key(user_prompt: str, model_used: str, num_responses: int) -> str:
+    """Content-addressed key for the generated-responses cache"""
+    digest = hashlib.sha256(f"{user_prompt}|{model_used}|{num_responses}".encode()).hexdigest()
+    return f"genresp:{digest}"
+
+
+# Global cache instance
+redis_cache = RedisCache()
@@ -1,27 +1,60 @@
 """
 Configuration settings for the LLM Evaluation API
 """
-from pydantic_settings import BaseSettings
-from dotenv import load_dotenv
-load_dotenv()
+from functools import lru_cache
+from typing import Literal
+from pydantic import field_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    
     # MongoDB Configuration
 
     mongodb_url: str
     database_name: str = "citrust"
     collection_name: str = "evaluations"
+    mongo_max_pool_size: int = 200
+    mongo_min_pool_size: int = 10
+    mongo_max_idle_time_ms: int = 300_000
+    mongo_server_selection_timeout_ms: int = 3_000
+    mongo_socket_timeout_ms: int = 5_000
+    # zlib ships with Python; add zstd/snappy after installing pymongo[zstd,snappy]
+    mongo_compressors: str = "zlib"
+    mongo_write_batch_size: int = 200
+    mongo_write_flush_interval: float = 0.5
+    mongo_write_queue_size: int = 10_000
+    
+    # Redis Configuration
+    redis_url: str = "redis://localhost:6379/0"
+    # Keep these short: the cache is best-effort, so a slow Redis should fail fast to a miss
+    redis_socket_connect_timeout: float = 0.5
+    redis_socket_timeout: float = 0.5
+    stats_cache_ttl: int = 45
+    response_cache_ttl: int = 86400
     
     # API Configuration
     app_name: str = "LLM Evaluation API"
     app_version: str = "1.0.0"
+    log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO"
+    # Worker processes started by `python app.py` (WEB_CONCURRENCY)
+    web_concurrency: int = 4
     
     gemini_api_key: str 
-
-    class Config:
-        env_file = ".env"
-        extra = "ignore"
+    # Enforced per process: with N uvicorn workers up to N x this many calls can be in flight
+    gemini_max_concurrency: int = 8
+    gemini_max_retries: int = 3
+    gemini_retry_base_delay: float = 0.5
+    
+    @field_validator("log_level", mode="before")
+    @classmethod
+    def normalize_log_level(cls, value):
+        """Accept LOG_LEVEL in any case, e.g. info; logging only knows the upper-case names"""
+        return value.upper() if isinstance(value, str) else value
 
 
-settings = Settings()
\ No newline at end of file
+@lru_cache
+def get_settings() -> Settings:
+    """Load settings once; later calls return the cached instance"""
+    return Settings()
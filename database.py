@@ -1,54 +1,219 @@
 """
 MongoDB database connection and operations
 """
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
-from config import settings
+from pymongo import AsyncMongoClient, IndexModel, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure, BulkWriteError, OperationFailure
+from config import get_settings
+import asyncio
 import logging
 
-logging.basicConfig(level=logging.INFO)
+settings = get_settings()
 logger = logging.getLogger(__name__)
 
+# Stamped on every evaluation written by this version. Older documents may repeat
+# a chat_id, so the unique chat_id index only covers documents carrying this field.
+EVALUATION_SCHEMA_VERSION = 2
+
+# Sentinel pushed onto the write buffer to make the flusher drain and exit
+_STOP = object()
+
+
+def _feedback_filter(chat_id: str, feedback_data: dict):
+    """
+    Match the chat's document unless it already holds newer feedback, so a stale
+    buffered update cannot overwrite a later direct write. schema_version lets the
+    query use the partial unique chat_id index.
+    """
+    return {
+        "chat_id": chat_id,
+        "schema_version": EVALUATION_SCHEMA_VERSION,
+        "$or": [
+            {"feedback_created_at": {"$exists": False}},
+            {"feedback_created_at": {"$lt": feedback_data["feedback_created_at"]}}
+        ]
+    }
+
 
 class MongoDB:
-    client: MongoClient = None
+    client: AsyncMongoClient = None
     
     def __init__(self):
         self.client = None
         self.db = None
         self.collection = None
+        self.buffer = None
+        self.flusher = None
+        # Buffered feedback updates that could not be applied; surfaced on /health
+        self.failed_writes = 0
     
-    def connect(self):
+    async def connect(self):
         """Connect to MongoDB"""
         try:
-            self.client = MongoClient(settings.mongodb_url)
+            self.client = AsyncMongoClient(
+                settings.mongodb_url,
+                maxPoolSize=settings.mongo_max_pool_size,
+                minPoolSize=settings.mongo_min_pool_size,
+                maxIdleTimeMS=settings.mongo_max_idle_time_ms,
+                serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+                socketTimeoutMS=settings.mongo_socket_timeout_ms,
+                compressors=settings.mongo_compressors,
+                retryWrites=True,
+                w="majority"
+            )
             # Test the connection
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
             
             self.db = self.client[settings.database_name]
             self.collection = self.db[settings.collection_name]
             
-            logger.info(f"Successfully connected to MongoDB database: {settings.database_name}")
-            logger.info(f"Using collection: {settings.collection_name}")
+            await self.ensure_indexes()
+            
+            logger.info("Successfully connected to MongoDB database: %s", settings.database_name)
+            logger.info("Using collection: %s", settings.collection_name)
         except ConnectionFailure as e:
-            logger.error(f"Failed to connect to MongoDB: {e}")
+            logger.error("Failed to connect to MongoDB: %s", e)
             raise
     
-    def close(self):
+    async def ensure_indexes(self):
+        """Create indexes for /stats counters and chat_id feedback updates (no-op if they already exist)"""
+        try:
+            await self.collection.create_indexes([
+                IndexModel([("thumbs", ASCENDING)]),
+                IndexModel([("user_id", ASCENDING)]),
+                IndexModel([("session_id", ASCENDING)]),
+                IndexModel(
+                    [("chat_id", ASCENDING)],
+                    name="chat_id_unique",
+                    unique=True,
+                    partialFilterExpression={"schema_version": {"$gte": EVALUATION_SCHEMA_VERSION}}
+                ),
+                IndexModel([("feedback_created_at", DESCENDING)])
+            ])
+        except OperationFailure as e:
+            logger.error("Failed to build indexes on collection %s: %s", settings.collection_name, e)
+            raise
+    
+    def start_flusher(self):
+        """Start the background task that batches buffered feedback into bulk_write"""
+        self.buffer = asyncio.Queue(maxsize=settings.mongo_write_queue_size)
+        self.flusher = asyncio.create_task(self._flush_loop())
+    
+    async def stop_flusher(self):
+        """Flush any buffered feedback and stop the background task"""
+        if self.flusher:
+            await self.buffer.put(_STOP)
+            await self.flusher
+            self.flusher = None
+    
+    async def _flush_loop(self):
+        """Drain the buffer every batch_size items or flush_interval seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.buffer.get()
+            if item is _STOP:
+                return
+            items = [item]
+            stopping = False
+            deadline = loop.time() + settings.mongo_write_flush_interval
+            while len(items) < settings.mongo_write_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.buffer.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+            await self._write_batch(items)
+            if stopping:
+                return
+    
+    async def _write_batch(self, items: list):
+        """Apply a batch of (chat_id, feedback_data) updates; unordered so one bad op doesn't fail the rest"""
+        # Unordered writes may apply in any order, so keep only the latest update per chat
+        items = list(dict(items).items())
+        operations = [
+            UpdateOne(_feedback_filter(chat_id, feedback_data), {"$set": feedback_data}, upsert=False)
+            for chat_id, feedback_data in items
+        ]
+        try:
+            result = await self.collection.bulk_write(operations, ordered=False)
+            unmatched = len(operations) - result.matched_count
+            if unmatched:
+                self.failed_writes += unmatched
+                logger.error("%d buffered feedback updates matched no chat or were superseded", unmatched)
+            logger.info("Flushed %d feedback updates", result.matched_count)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            self.failed_writes += len(write_errors)
+            for error in write_errors:
+                logger.error(
+                    "Dropped buffered feedback for chat %s: %s",
+                    items[error["index"]][0], error.get("errmsg")
+                )
+        except Exception as e:
+            self.failed_writes += len(items)
+            chat_ids = [chat_id for chat_id, _ in items]
+            logger.error("Dropped %d buffered feedback updates (chats %s): %s", len(items), chat_ids, e)
+    
+    async def warm_up(self):
+        """Open minPoolSize connections now so the first requests don't pay connect/TLS cost"""
+        await asyncio.gather(*[
+            self.db.command('ping') for _ in range(settings.mongo_min_pool_size)
+        ])
+        logger.info("Warmed up %d MongoDB connections", settings.mongo_min_pool_size)
+    
+    async def close(self):
         """Close MongoDB connection"""
         if self.client:
-            self.client.close()
+            await self.client.close()
             logger.info("MongoDB connection closed")
     
-    def insert_evaluation(self, evaluation_data: dict):
+    async def insert_evaluation(self, evaluation_data: dict):
         """Insert evaluation data into MongoDB"""
         try:
-            result = self.collection.insert_one(evaluation_data)
-            logger.info(f"Evaluation inserted with ID: {result.inserted_id}")
+            result = await self.collection.insert_one(evaluation_data)
+            logger.info("Evaluation inserted with ID: %s", result.inserted_id)
             return str(result.inserted_id)
         except Exception as e:
-            logger.error(f"Error inserting evaluation: {e}")
+            logger.error("Error inserting evaluation: %s", e)
+            raise
+    
+    async def update_evaluation_feedback(self, chat_id: str, feedback_data: dict):
+        """Set feedback fields on the chat's evaluation; returns its ID, or None if the chat is unknown"""
+        try:
+            result = await self.collection.find_one_and_update(
+                _feedback_filter(chat_id, feedback_data),
+                {"$set": feedback_data},
+                projection={"_id": 1},
+                upsert=False
+            )
+            if result is None:
+                # Either the chat is unknown or newer feedback is already recorded on it
+                result = await self.collection.find_one(
+                    {"chat_id": chat_id, "schema_version": EVALUATION_SCHEMA_VERSION},
+                    projection={"_id": 1}
+                )
+                if result is None:
+                    return None
+                logger.info("Feedback for chat %s superseded by newer feedback", chat_id)
+                return str(result["_id"])
+            logger.info("Feedback recorded on evaluation ID: %s", result["_id"])
+            return str(result["_id"])
+        except Exception as e:
+            logger.error("Error updating evaluation feedback: %s", e)
             raise
+    
+    def queue_feedback(self, chat_id: str, feedback_data: dict):
+        """Buffer a feedback update for the next batched write; returns False if the buffer is full"""
+        try:
+            self.buffer.put_nowait((chat_id, feedback_data))
+        except asyncio.QueueFull:
+            return False
+        return True
 
 
 # Global database instance
@@ -1,7 +1,7 @@
 """
 Pydantic models for data validation - UPDATED
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Dict, Any, Literal, Optional
 from datetime import datetime
 
@@ -19,14 +19,13 @@ class MultiResponseRequest(BaseModel):
     model_used: str = Field(default="gemini-2.0-flash", description="Which AI model to use")
     num_responses: int = Field(default=2, description="Number of responses to generate")
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "user_prompt": "Best laptop under 50k?",
-                "model_used": "gemini-2.0-flash",
-                "num_responses": 2
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "user_prompt": "Best laptop under 50k?",
+            "model_used": "gemini-2.0-flash",
+            "num_responses": 2
         }
+    })
 
 
 class FeedbackRequest(BaseModel):
@@ -39,18 +38,17 @@ class FeedbackRequest(BaseModel):
     user_id: str = Field(..., description="Unique identifier for the user")
     session_id: str = Field(..., description="Unique identifier for the session")
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "chat_id": "a1b2c3d4-5678-90ef-ghij-klmnopqrstuv",
-                "selected_response_index": 1,
-                "selected_response_text": "HP Pavilion with Ryzen 5...",
-                "thumbs": "up",
-                "feedback_text": "Liked the detailed specs",
-                "user_id": "user_123",
-                "session_id": "session_456"
-            }
+    model_config = ConfigDict(json_schema_extra={
+        "example": {
+            "chat_id": "a1b2c3d4-5678-90ef-ghij-klmnopqrstuv",
+            "selected_response_index": 1,
+            "selected_response_text": "HP Pavilion with Ryzen 5...",
+            "thumbs": "up",
+            "feedback_text": "Liked the detailed specs",
+            "user_id": "user_123",
+            "session_id": "session_456"
         }
+    })
 
 
 class MultiResponseResponse(BaseModel):
@@ -60,6 +58,7 @@ class MultiResponseResponse(BaseModel):
     user_prompt: str
     responses: List[str]
     chat_id: str
+    evaluation_id: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
 
@@ -68,4 +67,14 @@ class EvaluationResponse(BaseModel):
     success: bool
     message: str
     evaluation_id: str | None = None
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+
+class StatsResponse(BaseModel):
+    """Aggregate statistics about stored evaluations"""
+    total_evaluations: int
+    thumbs_up: int
+    thumbs_down: int
+    positive_rate: float
+    unique_users: int
+    unique_sessions: int
\ No newline at end of file